@@ -1,28 +1,166 @@
 import os
 import logging
-from flask import Flask, jsonify, request
-from google.cloud import secretmanager
+import functools
+import threading
+import orjson
+from flask import Flask, Response, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Response as WerkzeugResponse
+from cachetools import TTLCache
+from mypy_extensions import mypyc_attr
 import hashlib
+import hmac
 import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+if TYPE_CHECKING:
+    from google.cloud import secretmanager
+
+class JsonLogFormatter(logging.Formatter):
+    """Format log records as single-line JSON for Cloud Logging"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "logger": record.name,
+        }
+        if record.exc_info:
+            entry["stack_trace"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry).decode('utf-8')
+
+# Configure logging: WARNING and above in production unless LOG_LEVEL says
+# otherwise. On Cloud Run (K_SERVICE is set) logs are written as JSON, which
+# Cloud Logging ingests as structured entries with the right severity.
+_default_log_level = 'WARNING' if os.environ.get('ENVIRONMENT') == 'production' else 'INFO'
+_log_level = os.environ.get('LOG_LEVEL', _default_log_level).upper()
+# getLevelName returns the level number only for known level names; fall
+# back to the default rather than failing to start on a typo
+_log_level_valid = isinstance(logging.getLevelName(_log_level), int)
+logging.basicConfig(level=_log_level if _log_level_valid else _default_log_level)
+if os.environ.get('K_SERVICE'):
+    for _handler in logging.getLogger().handlers:
+        _handler.setFormatter(JsonLogFormatter())
 logger = logging.getLogger(__name__)
+if not _log_level_valid:
+    logger.warning("Unknown LOG_LEVEL %r, using %s", _log_level, _default_log_level)
+
+# Security headers added to every response
+_SEC_HEADERS = (
+    ('X-Content-Type-Options', 'nosniff'),
+    ('X-Frame-Options', 'DENY'),
+    ('X-XSS-Protection', '1; mode=block'),
+    ('Strict-Transport-Security', 'max-age=31536000; includeSubDomains'),
+    ('Content-Security-Policy', "default-src 'self'"),
+)
+
+# Interpreted subclasses are allowed so the class still works when main is
+# compiled with mypyc (Flask's test client subclasses the response class)
+@mypyc_attr(allow_interpreted_subclasses=True)
+class SecureResponse(Response):
+    """Response class that carries the security headers from construction"""
+    
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.headers.update(_SEC_HEADERS)
+    
+    @classmethod
+    def force_type(cls, response: Any, environ: Any = None) -> Any:
+        """Convert other responses (e.g. Werkzeug HTTP errors), adding the headers"""
+        if isinstance(response, cls):
+            return response
+        # Werkzeug converts by reassigning __class__, which fails once this
+        # class is compiled by mypyc (its object layout differs), so convert
+        # to a plain Werkzeug response and build a new instance from it
+        converted = WerkzeugResponse.force_type(response, environ)
+        return cls(converted.response, converted.status, converted.headers,
+                   direct_passthrough=converted.direct_passthrough)
 
 app = Flask(__name__)
+app.response_class = SecureResponse
+
+# Reject oversized request bodies before any JSON parsing happens
+app.config['MAX_CONTENT_LENGTH'] = 4096
+
+# Coarse clock: whole-second timestamp refreshed by a background thread, so
+# handlers read _now[0] instead of calling time.time() per request
+_now: List[int] = [int(time.time())]
+
+def _tick() -> None:
+    """Refresh the coarse clock once a second"""
+    while True:
+        time.sleep(1)
+        _now[0] = int(time.time())
+
+def _start_clock() -> None:
+    """Start the coarse clock thread (again after fork, as threads don't survive it)"""
+    _now[0] = int(time.time())
+    threading.Thread(target=_tick, name='coarse-clock', daemon=True).start()
+
+_start_clock()
+os.register_at_fork(after_in_child=_start_clock)
+
+def ojson(obj: Any, status: int = 200) -> Response:
+    """Build a JSON response, serialized with orjson"""
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
+# Secret values are cached in-process for this many seconds
+SECRET_CACHE_TTL = 300
+
+_sm_client: Optional["secretmanager.SecretManagerServiceClient"] = None
+_sm_client_lock = threading.Lock()
+
+# Serializes secret lookups so that when the TTL bucket rolls over, threads
+# waiting on the same secret share one RPC instead of each sending their own
+_secret_fetch_lock = threading.Lock()
+
+def _get_sm_client() -> "secretmanager.SecretManagerServiceClient":
+    """Return the shared Secret Manager client, creating it on first use"""
+    global _sm_client
+    if _sm_client is None:
+        with _sm_client_lock:
+            if _sm_client is None:
+                # Imported here rather than at module level: the client library
+                # pulls in gRPC and protobuf, which would slow down every cold start
+                from google.cloud import secretmanager
+                _sm_client = secretmanager.SecretManagerServiceClient(
+                    client_options={"api_endpoint": "secretmanager.googleapis.com:443"}
+                )
+    return _sm_client
 
-# Security headers middleware
-@app.after_request
-def after_request(response):
-    """Add security headers to all responses"""
-    response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['X-Frame-Options'] = 'DENY'
-    response.headers['X-XSS-Protection'] = '1; mode=block'
-    response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
-    response.headers['Content-Security-Policy'] = "default-src 'self'"
-    return response
-
-def get_secret(secret_name, project_id=None):
+@functools.lru_cache(maxsize=32)
+def _get_secret_cached(secret_name: str, project_id: str, epoch_bucket: int) -> str:
+    """
+    Fetch the latest version of a secret from Secret Manager
+    
+    Results are memoized per epoch_bucket, so a cached value expires once
+    the bucket rolls over. Exceptions are not cached.
+    """
+    client = _get_sm_client()
+    name = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
+    
+    response = client.access_secret_version(request={"name": name})
+    secret_value = response.payload.data.decode("UTF-8")
+    logger.info("Successfully retrieved secret: %s", secret_name)
+    return secret_value
+
+@functools.lru_cache(maxsize=1)
+def _secret_lookup_errors() -> tuple:
+    """
+    Secret Manager errors that mean the secret is unavailable
+    
+    Resolved lazily (an except clause is only evaluated once an exception
+    is raised) so google.api_core isn't imported at startup.
+    """
+    from google.api_core import exceptions
+    return (
+        exceptions.NotFound,
+        exceptions.PermissionDenied,
+        exceptions.DeadlineExceeded,
+        exceptions.ServiceUnavailable,
+    )
+
+def get_secret(secret_name: str, project_id: Optional[str] = None) -> Optional[str]:
     """
     Retrieve secret from Google Secret Manager
     
@@ -32,28 +170,35 @@ def get_secret(secret_name, project_id=None):
     
     Returns:
         str: Secret value or None if not found
+    
+    Raises:
+        Exception: Any error other than the secret being missing,
+            inaccessible or Secret Manager being unreachable
     """
+    if not project_id:
+        project_id = os.environ.get('GCP_PROJECT_ID') or os.environ.get('GOOGLE_CLOUD_PROJECT')
+    
+    if not project_id:
+        logger.warning("No project ID found, skipping secret retrieval")
+        return None
+    
+    epoch_bucket = _now[0] // SECRET_CACHE_TTL
     try:
-        if not project_id:
-            project_id = os.environ.get('GCP_PROJECT_ID') or os.environ.get('GOOGLE_CLOUD_PROJECT')
-        
-        if not project_id:
-            logger.warning("No project ID found, skipping secret retrieval")
-            return None
-            
-        client = secretmanager.SecretManagerServiceClient()
-        name = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
-        
-        response = client.access_secret_version(request={"name": name})
-        secret_value = response.payload.data.decode("UTF-8")
-        logger.info(f"Successfully retrieved secret: {secret_name}")
-        return secret_value
-        
-    except Exception as e:
-        logger.error(f"Error retrieving secret {secret_name}: {str(e)}")
+        with _secret_fetch_lock:
+            return _get_secret_cached(secret_name, project_id, epoch_bucket)
+    except _secret_lookup_errors() as e:
+        logger.error("Error retrieving secret %s: %s", secret_name, e.__class__.__name__)
         return None
 
-def validate_api_key(provided_key):
+# Recent validation results, keyed by a peppered BLAKE2b digest of the
+# provided key so the raw key is never held in memory. Failures are cached
+# too, so repeated bad keys don't each trigger a full lookup. The digests
+# never leave the process, so a random per-process pepper is enough.
+_auth_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+_AUTH_CACHE_PEPPER = os.urandom(32)
+_auth_cache_lock = threading.Lock()
+
+def validate_api_key(provided_key: str) -> bool:
     """
     Validate API key against stored secret
     
@@ -62,27 +207,41 @@ def validate_api_key(provided_key):
         
     Returns:
         bool: True if valid, False otherwise
+    
+    Raises:
+        Exception: Unexpected Secret Manager errors from get_secret, so an
+            outage surfaces as a server error rather than a rejected key
     """
-    try:
-        stored_key = get_secret('api-key')
-        if not stored_key:
-            # Fallback for development/testing
-            stored_key = os.environ.get('API_KEY', 'dev-key-123')
-            
-        # Use constant-time comparison to prevent timing attacks
-        return hashlib.sha256(provided_key.encode()).hexdigest() == \
-               hashlib.sha256(stored_key.encode()).hexdigest()
-    except Exception as e:
-        logger.error(f"Error validating API key: {str(e)}")
-        return False
+    key_hash = hashlib.blake2b(provided_key.encode('utf-8'), key=_AUTH_CACHE_PEPPER,
+                               digest_size=16).digest()
+    with _auth_cache_lock:
+        cached = _auth_cache.get(key_hash)
+    if cached is not None:
+        return cached
+    
+    stored_key = get_secret('api-key')
+    # Only results checked against Secret Manager are cached; otherwise a
+    # transient lookup failure would pin the fallback verdict for the TTL
+    from_secret_manager = bool(stored_key)
+    if not stored_key:
+        # Fallback for development/testing
+        stored_key = os.environ.get('API_KEY', 'dev-key-123')
+        
+    # Use constant-time comparison to prevent timing attacks
+    is_valid = hmac.compare_digest(provided_key.encode('utf-8'),
+                                   stored_key.encode('utf-8'))
+    if from_secret_manager:
+        with _auth_cache_lock:
+            _auth_cache[key_hash] = is_valid
+    return is_valid
 
-@app.route('/')
-def home():
-    """Main endpoint"""
-    return jsonify({
+@functools.lru_cache(maxsize=8)
+def _home_body(environment: str) -> bytes:
+    """Serialized main endpoint response, built once per environment"""
+    return orjson.dumps({
         "message": "Hello from Secure Cloud Run CI/CD pipeline!",
         "version": "2.0.0",
-        "environment": os.environ.get('ENVIRONMENT', 'development'),
+        "environment": environment,
         "security_features": [
             "Secret Manager integration",
             "Security headers",
@@ -91,17 +250,60 @@ def home():
         ]
     })
 
+@app.route('/')
+def home() -> Response:
+    """Main endpoint"""
+    body = _home_body(os.environ.get('ENVIRONMENT', 'development'))
+    return app.response_class(body, mimetype='application/json')
+
+# Only the timestamp changes between health check responses, and only once
+# a second with the coarse clock, so the last body is kept as (timestamp, body)
+_HEALTH_PREFIX = b'{"status":"healthy","timestamp":'
+_HEALTH_SUFFIX = b',"version":"2.0.0"}'
+_health_cache: List[Tuple[int, bytes]] = [(-1, b'')]
+
+def _health_body() -> bytes:
+    """Health check response body, rebuilt only when the clock ticks"""
+    now = _now[0]
+    timestamp, body = _health_cache[0]
+    if timestamp != now:
+        body = _HEALTH_PREFIX + str(now).encode('ascii') + _HEALTH_SUFFIX
+        _health_cache[0] = (now, body)
+    return body
+
 @app.route('/health')
-def health_check():
+def health_check() -> Response:
     """Health check endpoint for load balancer"""
-    return jsonify({
-        "status": "healthy",
-        "timestamp": int(time.time()),
-        "version": "2.0.0"
-    }), 200
+    body = _health_body()
+    return app.response_class(body, status=200, mimetype='application/json')
+
+def wsgi_entry(environ: Dict[str, Any], start_response: Any) -> Any:
+    """
+    WSGI entry point used by gunicorn
+    
+    Answers GET /health directly, skipping Flask's routing, request hooks
+    and error handlers; every other request is passed to the Flask app.
+    """
+    if environ.get('PATH_INFO') == '/health' and environ.get('REQUEST_METHOD') == 'GET':
+        body = _health_body()
+        start_response('200 OK', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+            *_SEC_HEADERS,
+        ])
+        return [body]
+    return app(environ, start_response)
+
+def _is_utf8_encodable(text: str) -> bool:
+    """Check text has no lone surrogates, which JSON allows but orjson can't serialize"""
+    try:
+        text.encode('utf-8')
+    except UnicodeEncodeError:
+        return False
+    return True
 
 @app.route('/api/secure', methods=['POST'])
-def secure_endpoint():
+def secure_endpoint() -> Response:
     """
     Secure endpoint that requires API key authentication
     Demonstrates proper secret management
@@ -112,40 +314,41 @@ def secure_endpoint():
         
         if not api_key:
             logger.warning("API request without API key")
-            return jsonify({"error": "API key required"}), 401
+            return ojson({"error": "API key required"}, 401)
             
         # Validate API key
         if not validate_api_key(api_key):
             logger.warning("Invalid API key provided")
-            return jsonify({"error": "Invalid API key"}), 403
+            return ojson({"error": "Invalid API key"}, 403)
             
         # Process request data (with input validation)
-        data = request.get_json()
-        if not data or 'message' not in data:
-            return jsonify({"error": "Invalid request data"}), 400
+        data = request.get_json(silent=True, cache=False)
+        message = data.get('message') if isinstance(data, dict) else None
+        if not isinstance(message, str) or not _is_utf8_encodable(message):
+            return ojson({"error": "Invalid request data"}, 400)
             
         # Sanitize input
-        message = str(data['message'])[:100]  # Limit length
+        message = message[:100]  # Limit length
         
         logger.info("Secure endpoint accessed successfully")
-        return jsonify({
+        return ojson({
             "status": "success",
             "processed_message": f"Processed: {message}",
-            "timestamp": int(time.time())
+            "timestamp": _now[0]
         })
         
+    except HTTPException:
+        # Let Flask render HTTP errors such as 413 Request Entity Too Large
+        raise
     except Exception as e:
-        logger.error(f"Error in secure endpoint: {str(e)}")
-        return jsonify({"error": "Internal server error"}), 500
+        logger.exception("Error in secure endpoint: %s", e)
+        return ojson({"error": "Internal server error"}, 500)
 
-@app.route('/api/config')
-def get_config():
-    """
-    Get non-sensitive configuration information
-    Demonstrates separation of sensitive and non-sensitive data
-    """
-    config = {
-        "environment": os.environ.get('ENVIRONMENT', 'development'),
+@functools.lru_cache(maxsize=8)
+def _config_body(environment: str) -> bytes:
+    """Serialized configuration response, built once per environment"""
+    config: Dict[str, Any] = {
+        "environment": environment,
         "version": "2.0.0",
         "features": {
             "secret_manager": True,
@@ -156,35 +359,55 @@ def get_config():
     }
     
     # Only include debug info in non-production environments
-    if config["environment"] != "production":
+    if environment != "production":
         config["debug"] = {
             "python_version": os.environ.get('PYTHON_VERSION', 'unknown'),
             "container_id": os.environ.get('HOSTNAME', 'unknown')
         }
     
-    return jsonify(config)
+    return orjson.dumps(config)
+
+@app.route('/api/config')
+def get_config() -> Response:
+    """
+    Get non-sensitive configuration information
+    Demonstrates separation of sensitive and non-sensitive data
+    """
+    body = _config_body(os.environ.get('ENVIRONMENT', 'development'))
+    return app.response_class(body, mimetype='application/json')
 
 @app.errorhandler(404)
-def not_found(error):
+def not_found(error: Exception) -> Response:
     """Custom 404 handler"""
-    return jsonify({"error": "Endpoint not found"}), 404
+    return ojson({"error": "Endpoint not found"}, 404)
+
+@app.errorhandler(413)
+def request_too_large(error: Exception) -> Response:
+    """Custom 413 handler"""
+    return ojson({"error": "Request body too large"}, 413)
 
 @app.errorhandler(500)
-def internal_error(error):
+def internal_error(error: Exception) -> Response:
     """Custom 500 handler"""
-    logger.error(f"Internal server error: {str(error)}")
-    return jsonify({"error": "Internal server error"}), 500
+    logger.error("Internal server error: %s", error)
+    return ojson({"error": "Internal server error"}, 500)
 
 if __name__ == "__main__":
+    # Flask's built-in server is for local development only; containers
+    # serve the app with gunicorn (see Dockerfile)
+    environment = os.environ.get('ENVIRONMENT', 'development')
+    if environment != 'development':
+        logger.warning("Built-in server is not for production use; run under gunicorn instead")
+    
     # Security: Don't run in debug mode in production
-    debug_mode = os.environ.get('ENVIRONMENT', 'development') != 'production'
+    debug_mode = environment != 'production'
     
     # Get port from environment (Cloud Run uses PORT env var)
     port = int(os.environ.get('PORT', 8080))
     
-    logger.info(f"Starting application on port {port}")
-    logger.info(f"Environment: {os.environ.get('ENVIRONMENT', 'development')}")
-    logger.info(f"Debug mode: {debug_mode}")
+    logger.info("Starting application on port %s", port)
+    logger.info("Environment: %s", environment)
+    logger.info("Debug mode: %s", debug_mode)
     
     # Run the application
     app.run(
@@ -1,8 +1,23 @@
 import pytest
 import json
+import logging
 import os
 from unittest.mock import patch, MagicMock
-from main import app, get_secret, validate_api_key
+from google.api_core import exceptions as gcp_exceptions
+import main
+from werkzeug.test import Client
+from main import app, get_secret, validate_api_key, wsgi_entry
+
+@pytest.fixture(autouse=True)
+def reset_secret_cache():
+    """Clear cached secrets, auth results and the shared client between tests"""
+    main._get_secret_cached.cache_clear()
+    main._auth_cache.clear()
+    main._sm_client = None
+    yield
+    main._get_secret_cached.cache_clear()
+    main._auth_cache.clear()
+    main._sm_client = None
 
 @pytest.fixture
 def client():
@@ -28,6 +43,21 @@ def test_health_check(client):
     assert data['status'] == 'healthy'
     assert 'timestamp' in data
 
+def test_wsgi_entry_health_check():
+    """Test health check served directly by the WSGI entry point"""
+    wsgi_client = Client(wsgi_entry)
+    response = wsgi_client.get('/health')
+    assert response.status_code == 200
+    assert response.headers['X-Frame-Options'] == 'DENY'
+    data = json.loads(response.data)
+    assert data['status'] == 'healthy'
+    assert 'timestamp' in data
+    
+    # Other requests fall through to the Flask app
+    response = wsgi_client.get('/')
+    assert response.status_code == 200
+    assert 'message' in json.loads(response.data)
+
 def test_security_headers(client):
     """Test that security headers are present"""
     response = client.get('/')
@@ -37,6 +67,13 @@ def test_security_headers(client):
     assert 'Strict-Transport-Security' in response.headers
     assert 'Content-Security-Policy' in response.headers
 
+def test_security_headers_on_framework_errors(client):
+    """Test that responses generated by Flask itself carry security headers"""
+    response = client.get('/api/secure')  # GET is not allowed
+    assert response.status_code == 405
+    assert response.headers['X-Frame-Options'] == 'DENY'
+    assert response.headers.getlist('X-Content-Type-Options') == ['nosniff']
+
 def test_config_endpoint(client):
     """Test configuration endpoint"""
     response = client.get('/api/config')
@@ -77,6 +114,23 @@ def test_secure_endpoint_valid_api_key(mock_get_secret, client):
     assert data['status'] == 'success'
     assert 'Processed: test message' in data['processed_message']
 
+@patch('google.cloud.secretmanager.SecretManagerServiceClient')
+def test_secure_endpoint_secret_manager_failure(mock_client, client, caplog):
+    """Test that an unexpected Secret Manager error is a logged 500, not a rejected key"""
+    mock_client.side_effect = RuntimeError('Unexpected')
+    
+    with patch.dict(os.environ, {'GCP_PROJECT_ID': 'test-project'}):
+        response = client.post('/api/secure', 
+                              json={'message': 'test'},
+                              headers={'X-API-Key': 'test-key'})
+    assert response.status_code == 500
+    data = json.loads(response.data)
+    assert data['error'] == 'Internal server error'
+    
+    # The traceback is kept so it shows up as stack_trace in Cloud Logging
+    errors = [r for r in caplog.records if r.getMessage().startswith('Error in secure endpoint')]
+    assert errors and errors[0].exc_info is not None
+
 def test_secure_endpoint_invalid_json(client):
     """Test secure endpoint with invalid JSON data"""
     with patch('main.get_secret', return_value='test-key'):
@@ -85,6 +139,36 @@ def test_secure_endpoint_invalid_json(client):
                               headers={'X-API-Key': 'test-key'})
         assert response.status_code == 400
 
+def test_secure_endpoint_non_string_message(client):
+    """Test secure endpoint rejects non-string messages"""
+    with patch('main.get_secret', return_value='test-key'):
+        for payload in ({'message': None}, {'message': 42}, {'message': {'a': 1}}):
+            response = client.post('/api/secure', 
+                                  json=payload,
+                                  headers={'X-API-Key': 'test-key'})
+            assert response.status_code == 400
+
+def test_secure_endpoint_lone_surrogate_message(client):
+    """Test secure endpoint rejects messages that aren't valid Unicode text"""
+    with patch('main.get_secret', return_value='test-key'):
+        response = client.post('/api/secure', 
+                              data='{"message": "\\ud800x"}',
+                              content_type='application/json',
+                              headers={'X-API-Key': 'test-key'})
+        assert response.status_code == 400
+        data = json.loads(response.data)
+        assert 'Invalid request data' in data['error']
+
+def test_secure_endpoint_body_too_large(client):
+    """Test secure endpoint rejects oversized request bodies"""
+    with patch('main.get_secret', return_value='test-key'):
+        response = client.post('/api/secure', 
+                              json={'message': 'x' * 5000},
+                              headers={'X-API-Key': 'test-key'})
+        assert response.status_code == 413
+        data = json.loads(response.data)
+        assert 'too large' in data['error']
+
 def test_404_handler(client):
     """Test custom 404 handler"""
     response = client.get('/nonexistent')
@@ -92,7 +176,7 @@ def test_404_handler(client):
     data = json.loads(response.data)
     assert 'Endpoint not found' in data['error']
 
-@patch('main.secretmanager.SecretManagerServiceClient')
+@patch('google.cloud.secretmanager.SecretManagerServiceClient')
 def test_get_secret_success(mock_client):
     """Test successful secret retrieval"""
     # Mock the secret manager client
@@ -109,21 +193,84 @@ def test_get_secret_success(mock_client):
         result = get_secret('test-secret')
         assert result == 'secret-value'
 
+@patch('google.cloud.secretmanager.SecretManagerServiceClient')
+def test_get_secret_cached(mock_client):
+    """Test that secrets and the client are reused across calls"""
+    mock_instance = MagicMock()
+    mock_client.return_value = mock_instance
+    mock_response = MagicMock()
+    mock_response.payload.data = b'secret-value'
+    mock_instance.access_secret_version.return_value = mock_response
+    
+    with patch.dict(os.environ, {'GCP_PROJECT_ID': 'test-project'}):
+        assert get_secret('test-secret') == 'secret-value'
+        assert get_secret('test-secret') == 'secret-value'
+    
+    mock_client.assert_called_once()
+    mock_instance.access_secret_version.assert_called_once()
+
+def test_secretmanager_not_imported_at_startup():
+    """Test that the Secret Manager client library is loaded lazily"""
+    import subprocess
+    import sys
+    code = "import sys, main; print('google.cloud.secretmanager' in sys.modules)"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.stdout.strip() == 'False'
+
+@patch('google.cloud.secretmanager.SecretManagerServiceClient')
+def test_get_secret_concurrent_first_calls(mock_client):
+    """Test that concurrent first lookups build one client and send one RPC"""
+    import threading
+    import time as time_module
+    
+    def slow_client(*args, **kwargs):
+        time_module.sleep(0.05)
+        return mock_instance
+    
+    mock_instance = MagicMock()
+    mock_client.side_effect = slow_client
+    mock_response = MagicMock()
+    mock_response.payload.data = b'secret-value'
+    mock_instance.access_secret_version.return_value = mock_response
+    
+    results = []
+    with patch.dict(os.environ, {'GCP_PROJECT_ID': 'test-project'}):
+        threads = [threading.Thread(target=lambda: results.append(get_secret('test-secret')))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    
+    assert results == ['secret-value'] * 8
+    mock_client.assert_called_once()
+    mock_instance.access_secret_version.assert_called_once()
+
 def test_get_secret_no_project_id():
     """Test secret retrieval without project ID"""
     with patch.dict(os.environ, {}, clear=True):
         result = get_secret('test-secret')
         assert result is None
 
-@patch('main.secretmanager.SecretManagerServiceClient')
+@patch('google.cloud.secretmanager.SecretManagerServiceClient')
 def test_get_secret_exception(mock_client):
     """Test secret retrieval with exception"""
-    mock_client.side_effect = Exception('Connection error')
+    mock_client.side_effect = gcp_exceptions.ServiceUnavailable('Connection error')
     
     with patch.dict(os.environ, {'GCP_PROJECT_ID': 'test-project'}):
         result = get_secret('test-secret')
         assert result is None
 
+@patch('google.cloud.secretmanager.SecretManagerServiceClient')
+def test_get_secret_unexpected_exception(mock_client):
+    """Test that unexpected errors are not swallowed by secret retrieval"""
+    mock_client.side_effect = RuntimeError('Unexpected')
+    
+    with patch.dict(os.environ, {'GCP_PROJECT_ID': 'test-project'}):
+        with pytest.raises(RuntimeError):
+            get_secret('test-secret')
+
 def test_validate_api_key_fallback():
     """Test API key validation with fallback to environment variable"""
     with patch('main.get_secret', return_value=None):
@@ -131,6 +278,46 @@ def test_validate_api_key_fallback():
             assert validate_api_key('env-key') is True
             assert validate_api_key('wrong-key') is False
 
+def test_validate_api_key_cached():
+    """Test that validation results are cached, including failures"""
+    with patch('main.get_secret', return_value='cached-key') as mock_get_secret:
+        assert validate_api_key('cached-key') is True
+        assert validate_api_key('cached-key') is True
+        assert validate_api_key('bad-key') is False
+        assert validate_api_key('bad-key') is False
+        assert mock_get_secret.call_count == 2
+
+def test_validate_api_key_fallback_not_cached():
+    """Test that results checked against the fallback key are not cached"""
+    with patch('main.get_secret', return_value=None) as mock_get_secret:
+        with patch.dict(os.environ, {'API_KEY': 'env-key'}):
+            assert validate_api_key('env-key') is True
+            assert validate_api_key('env-key') is True
+        assert mock_get_secret.call_count == 2
+
+@patch('google.cloud.secretmanager.SecretManagerServiceClient')
+def test_secure_endpoint_recovers_after_secret_timeout(mock_client, client):
+    """Test that a valid key is accepted once Secret Manager recovers from a timeout"""
+    mock_instance = MagicMock()
+    mock_client.return_value = mock_instance
+    mock_response = MagicMock()
+    mock_response.payload.data = b'real-key'
+    mock_instance.access_secret_version.side_effect = [
+        gcp_exceptions.DeadlineExceeded('Timeout'),
+        mock_response,
+    ]
+    
+    with patch.dict(os.environ, {'GCP_PROJECT_ID': 'test-project'}):
+        response = client.post('/api/secure', 
+                              json={'message': 'test'},
+                              headers={'X-API-Key': 'real-key'})
+        assert response.status_code == 403
+        
+        response = client.post('/api/secure', 
+                              json={'message': 'test'},
+                              headers={'X-API-Key': 'real-key'})
+        assert response.status_code == 200
+
 def test_input_length_limit(client):
     """Test that input length is limited for security"""
     long_message = 'x' * 200  # Message longer than 100 chars
@@ -159,6 +346,26 @@ def test_environment_debug_info(client):
         data = json.loads(response.data)
         assert 'debug' not in data
 
+def test_json_log_formatter():
+    """Test that log records are formatted as structured JSON"""
+    record = logging.LogRecord('main', logging.WARNING, __file__, 1,
+                               'Secret %s missing', ('api-key',), None)
+    entry = json.loads(main.JsonLogFormatter().format(record))
+    assert entry['severity'] == 'WARNING'
+    assert entry['message'] == 'Secret api-key missing'
+
+def test_invalid_log_level_falls_back():
+    """Test that an unknown LOG_LEVEL doesn't prevent the app from starting"""
+    import subprocess
+    import sys
+    env = dict(os.environ, LOG_LEVEL='VERBOSE', ENVIRONMENT='production')
+    code = "import logging, main; print(logging.getLogger().level)"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=env,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == str(logging.WARNING)
+    assert "Unknown LOG_LEVEL 'VERBOSE'" in result.stderr
+
 def test_json_response_content_type(client):
     """Test that responses have correct content type"""
     response = client.get('/')
@@ -177,7 +384,7 @@ class TestSecurityFeatures:
     def test_constant_time_comparison(self):
         """Test that API key validation uses constant-time comparison"""
         # This tests the security of the validate_api_key function
-        # by ensuring it uses hashlib for comparison (prevents timing attacks)
+        # by ensuring it uses hmac.compare_digest (prevents timing attacks)
         with patch('main.get_secret', return_value='correct-key'):
             # Both should take similar time regardless of how wrong the key is
             result1 = validate_api_key('wrong-key-1')
@@ -268,23 +475,23 @@ class TestPerformanceAndReliability:
 # Integration tests for Secret Manager
 class TestSecretManagerIntegration:
     
-    @patch('main.secretmanager.SecretManagerServiceClient')
+    @patch('google.cloud.secretmanager.SecretManagerServiceClient')
     def test_secret_manager_timeout(self, mock_client):
         """Test Secret Manager timeout handling"""
         mock_instance = MagicMock()
         mock_client.return_value = mock_instance
-        mock_instance.access_secret_version.side_effect = Exception('Timeout')
+        mock_instance.access_secret_version.side_effect = gcp_exceptions.DeadlineExceeded('Timeout')
         
         with patch.dict(os.environ, {'GCP_PROJECT_ID': 'test-project'}):
             result = get_secret('test-secret')
             assert result is None
     
-    @patch('main.secretmanager.SecretManagerServiceClient')
+    @patch('google.cloud.secretmanager.SecretManagerServiceClient')
     def test_secret_manager_permission_denied(self, mock_client):
         """Test Secret Manager permission denied"""
         mock_instance = MagicMock()
         mock_client.return_value = mock_instance
-        mock_instance.access_secret_version.side_effect = Exception('Permission denied')
+        mock_instance.access_secret_version.side_effect = gcp_exceptions.PermissionDenied('Permission denied')
         
         with patch.dict(os.environ, {'GCP_PROJECT_ID': 'test-project'}):
             result = get_secret('test-secret')
@@ -294,7 +501,7 @@ class TestSecretManagerIntegration:
         """Test project ID resolution from different environment variables"""
         # Test GCP_PROJECT_ID
         with patch.dict(os.environ, {'GCP_PROJECT_ID': 'project-1'}, clear=True):
-            with patch('main.secretmanager.SecretManagerServiceClient') as mock_client:
+            with patch('google.cloud.secretmanager.SecretManagerServiceClient') as mock_client:
                 mock_instance = MagicMock()
                 mock_client.return_value = mock_instance
                 mock_response = MagicMock()
@@ -305,8 +512,9 @@ class TestSecretManagerIntegration:
                 assert result == 'secret'
         
         # Test GOOGLE_CLOUD_PROJECT (Cloud Run default)
+        main._sm_client = None  # Drop the client shared from the previous call
         with patch.dict(os.environ, {'GOOGLE_CLOUD_PROJECT': 'project-2'}, clear=True):
-            with patch('main.secretmanager.SecretManagerServiceClient') as mock_client:
+            with patch('google.cloud.secretmanager.SecretManagerServiceClient') as mock_client:
                 mock_instance = MagicMock()
                 mock_client.return_value = mock_instance
                 mock_response = MagicMock()
@@ -316,5 +524,56 @@ class TestSecretManagerIntegration:
                 result = get_secret('test-secret')
                 assert result == 'secret2'
 
+# The container ships main.py compiled with mypyc, which can behave differently
+# from the source module (and ignores patch() on module globals), so exercise
+# the compiled build end to end through the response and error paths
+_COMPILED_SMOKE_TEST = """
+import json, main
+assert main.__file__.endswith('.so'), main.__file__
+client = main.app.test_client()
+results = {}
+for name, response in [
+    ('home', client.get('/')),
+    ('health', client.get('/health')),
+    ('not_found', client.get('/nonexistent')),
+    ('method_not_allowed', client.get('/api/secure')),
+    ('too_large', client.post('/api/secure', json={'message': 'x' * 5000},
+                              headers={'X-API-Key': 'dev-key-123'})),
+    ('secure', client.post('/api/secure', json={'message': 'hi'},
+                           headers={'X-API-Key': 'dev-key-123'})),
+]:
+    results[name] = [response.status_code, response.headers.get('X-Frame-Options')]
+print(json.dumps(results))
+"""
+
+class TestCompiledModule:
+    
+    def test_compiled_module_responses(self, tmp_path):
+        """Test the mypyc-compiled module serves the same status codes and headers"""
+        pytest.importorskip('mypyc')
+        import shutil
+        import subprocess
+        import sys
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'), tmp_path)
+        env = {k: v for k, v in os.environ.items()
+               if k not in ('GCP_PROJECT_ID', 'GOOGLE_CLOUD_PROJECT', 'API_KEY')}
+        
+        build = subprocess.run([sys.executable, '-m', 'mypyc', '--ignore-missing-imports', 'main.py'],
+                               cwd=tmp_path, env=env, capture_output=True, text=True)
+        assert build.returncode == 0, build.stdout + build.stderr
+        
+        result = subprocess.run([sys.executable, '-c', _COMPILED_SMOKE_TEST],
+                                cwd=tmp_path, env=env, capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+        results = json.loads(result.stdout.strip().splitlines()[-1])
+        assert results == {
+            'home': [200, 'DENY'],
+            'health': [200, 'DENY'],
+            'not_found': [404, 'DENY'],
+            'method_not_allowed': [405, 'DENY'],
+            'too_large': [413, 'DENY'],
+            'secure': [200, 'DENY'],
+        }
+
 if __name__ == '__main__':
     pytest.main(['-v', '--cov=main', '--cov-report=term-missing'])